@@ -1,16 +1,46 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request
+import functools
+import gzip
+import hashlib
+import os
 import requests
+from requests.adapters import HTTPAdapter
+import threading
 import time
 
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
 
 TAILSCALE_BASE = 'https://thinkpad.tail824ac3.ts.net'
+SENSOR_URL = f"{TAILSCALE_BASE}/api/sensor"
+LOG_URL = f"{TAILSCALE_BASE}/api/sensor/log"
+CALIBRATION_URL = f"{TAILSCALE_BASE}/api/sensor/calibration"
 # Supported devices. Whitelisting keeps the cache key space bounded and stops
 # arbitrary `device` values from being forwarded upstream on a public deploy.
-ALLOWED_DEVICES = {'office'}
+ALLOWED_DEVICES = frozenset({'office'})
+# Base cache TTLs in seconds, overridable per deploy for tuning.
+SENSOR_TTL = int(os.environ.get('SENSOR_CACHE_TTL', 60))
+CALIBRATION_TTL = int(os.environ.get('CALIBRATION_CACHE_TTL', 3600))
+# A fetch taking this long doubles the TTL of its result (scaled linearly below).
+SLOW_FETCH_SECONDS = 5
+# Upstream bodies above this are refused rather than buffered and cached.
+# A week of minute readings is well under 1 MB.
+MAX_UPSTREAM_BYTES = 4 * 1024 * 1024
+# How long a concurrent miss waits on another request's fetch; a little above
+# the 10s upstream timeout.
+FLIGHT_WAIT_SECONDS = 15
+# Responses smaller than this are sent uncompressed.
+GZIP_MIN_SIZE = 1024
 # Module-level cache: best-effort on Vercel (resets on cold start, not shared
 # across instances). Key space is bounded by the device whitelist + clamped params.
+# Entries are (data, expiry) with expiry on the time.monotonic() clock.
 _cache = {}
+_cache_lock = threading.Lock()
+# Keys currently being fetched upstream -> _Flight.
+_inflight = {}
+# Shared session so warm instances reuse the keep-alive TLS connection to the
+# Tailscale funnel instead of paying a fresh handshake on every cache miss.
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=10))
 
 
 def normalize_device(value):
@@ -27,25 +57,149 @@ def clamp_int(value, default, lo, hi):
     return max(lo, min(hi, n))
 
 
+class UpstreamError(Exception):
+    """The backend answered, but not with something we can serve."""
+
+
+def json_body(r):
+    """Turn an upstream JSON response into (body, gzipped or None, etag).
+
+    The body is cached and served as-is: parsing it only to re-encode it with
+    jsonify would double the per-miss CPU for no change in the payload. The
+    etag and gzip variant are computed once here so cache hits neither rehash
+    nor recompress the body. Raises on HTTP errors and on bodies that aren't
+    JSON or are too large.
+    """
+    r.raise_for_status()
+    content_type = r.headers.get('Content-Type', '')
+    if not content_type.startswith('application/json'):
+        raise UpstreamError(f"unexpected upstream content type: {content_type or 'none'}")
+    # Read incrementally so a runaway body (typically chunked, with no
+    # Content-Length to check up front) is cut off at the cap, not buffered.
+    chunks = []
+    size = 0
+    for chunk in r.iter_content(64 * 1024):
+        size += len(chunk)
+        if size > MAX_UPSTREAM_BYTES:
+            raise UpstreamError("upstream response too large")
+        chunks.append(chunk)
+    body = b''.join(chunks)
+    # Sensor history is repetitive JSON and shrinks several-fold under gzip;
+    # tiny bodies (calibration, errors) aren't worth the header overhead.
+    gzipped = gzip.compress(body, compresslevel=6) if len(body) >= GZIP_MIN_SIZE else None
+    return body, gzipped, hashlib.blake2b(body, digest_size=8).hexdigest()
+
+
+def json_response(payload):
+    """Serve a cached json_body() payload, answering 304 if the client already has it."""
+    body, gzipped, etag = payload
+    if gzipped is not None and request.accept_encodings['gzip']:
+        resp = Response(gzipped, mimetype='application/json')
+        resp.content_encoding = 'gzip'
+        etag += '-gz'
+    else:
+        resp = Response(body, mimetype='application/json')
+    resp.vary.add('Accept-Encoding')
+    resp.set_etag(etag)
+    # Let the browser keep the body but revalidate every poll; unchanged data
+    # then costs an empty 304 instead of the full payload.
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+
+class _Flight:
+    """An in-progress upstream fetch that concurrent misses wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
 def get_cached(key, ttl_seconds, fetch_fn):
-    """Return cached data if valid, otherwise fetch and cache."""
-    now = time.time()
-    if key in _cache and _cache[key][1] > now:
-        return _cache[key][0]
+    """Return cached data if valid, otherwise fetch and cache.
+
+    Concurrent misses for the same key share one upstream fetch instead of
+    each hitting the backend when an entry expires.
+    """
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _inflight[key] = _Flight()
+
+    if not leader:
+        finished = flight.done.wait(FLIGHT_WAIT_SECONDS)
+        with _cache_lock:
+            entry = _cache.get(key)
+        # Fresh if the leader succeeded, stale if it failed (or is still
+        # running) but there was a fallback
+        if entry is not None:
+            return entry[0]
+        if not finished:
+            raise UpstreamError("timed out waiting for upstream")
+        # error is unset if the leader died from a non-Exception BaseException
+        raise flight.error or UpstreamError("upstream fetch was interrupted")
+
     try:
+        started = time.monotonic()
         data = fetch_fn()
-        _cache[key] = (data, now + ttl_seconds)
+        # A slow backend is a busy one: hold its answer longer instead of
+        # asking again at the usual rate.
+        ttl_seconds *= 1 + min((time.monotonic() - started) / SLOW_FETCH_SECONDS, 1)
+        with _cache_lock:
+            _cache[key] = (data, time.monotonic() + ttl_seconds)
         return data
-    except Exception:
+    except Exception as e:
+        flight.error = e
         # Return stale cache if fetch fails
-        if key in _cache:
-            return _cache[key][0]
+        if entry is not None:
+            return entry[0]
         raise
+    finally:
+        with _cache_lock:
+            del _inflight[key]
+        flight.done.set()
+
+
+def proxy(cache_key, url, params, ttl_seconds):
+    """Serve an upstream GET through the cache as a conditional JSON response."""
+    def fetch():
+        with _session.get(url, params=params, timeout=10, stream=True) as r:
+            return json_body(r)
+
+    return json_response(get_cached(cache_key, ttl_seconds, fetch))
+
+
+@app.errorhandler(requests.RequestException)
+@app.errorhandler(UpstreamError)
+def upstream_failed(e):
+    # Only reached when there's no stale cache entry to fall back on.
+    return jsonify({"error": str(e)}), 502
+
+
+@functools.cache
+def rendered_index():
+    """The dashboard template takes no per-request context, so render it once.
+
+    Returns (html, etag).
+    """
+    html = render_template('index.html')
+    return html, hashlib.blake2b(html.encode(), digest_size=8).hexdigest()
 
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    if app.debug:  # keep template edits live during local development
+        return render_template('index.html')
+    html, etag = rendered_index()
+    resp = Response(html, mimetype='text/html')
+    resp.set_etag(etag)
+    # Revalidate on every load so a new deploy is picked up immediately
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
 
 
 @app.route('/api/sensor')
@@ -55,18 +209,7 @@ def proxy_sensor():
         return jsonify({"error": "unknown device"}), 400
     hours = clamp_int(request.args.get('hours'), 24, 1, 168)
     cache_key = f"sensor:{device}:{hours}"
-
-    def fetch():
-        r = requests.get(f"{TAILSCALE_BASE}/api/sensor",
-                         params={'device': device, 'hours': hours}, timeout=10)
-        r.raise_for_status()
-        return r.json()
-
-    try:
-        data = get_cached(cache_key, 60, fetch)  # 60s TTL
-        return jsonify(data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 502
+    return proxy(cache_key, SENSOR_URL, {'device': device, 'hours': hours}, SENSOR_TTL)
 
 
 @app.route('/api/sensor/log')
@@ -77,18 +220,7 @@ def proxy_log():
     hours = clamp_int(request.args.get('hours'), 24, 1, 168)
     limit = clamp_int(request.args.get('limit'), 50, 1, 200)
     cache_key = f"log:{device}:{hours}:{limit}"
-
-    def fetch():
-        r = requests.get(f"{TAILSCALE_BASE}/api/sensor/log",
-                         params={'device': device, 'hours': hours, 'limit': limit}, timeout=10)
-        r.raise_for_status()
-        return r.json()
-
-    try:
-        data = get_cached(cache_key, 60, fetch)  # 60s TTL
-        return jsonify(data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 502
+    return proxy(cache_key, LOG_URL, {'device': device, 'hours': hours, 'limit': limit}, SENSOR_TTL)
 
 
 @app.route('/api/sensor/calibration')
@@ -97,15 +229,4 @@ def proxy_calibration():
     if device is None:
         return jsonify({"error": "unknown device"}), 400
     cache_key = f"calibration:{device}"
-
-    def fetch():
-        r = requests.get(f"{TAILSCALE_BASE}/api/sensor/calibration",
-                         params={'device': device}, timeout=10)
-        r.raise_for_status()
-        return r.json()
-
-    try:
-        data = get_cached(cache_key, 3600, fetch)  # 1hr TTL
-        return jsonify(data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 502
+    return proxy(cache_key, CALIBRATION_URL, {'device': device}, CALIBRATION_TTL)